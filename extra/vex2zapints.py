@@ -19,19 +19,30 @@ Source and telescope names should match the names used in the VEX file."""
 
 #############################################################################################
 
-import datetime, math, optparse, subprocess, sys
+import mmap, optparse, struct, subprocess, sys
+import numpy as np
 import vex #  Mark Kettenis' Python VEX parser (http://www.jive.nl/nexpres/doku.php?id=nexpres:nexpres_wp7)
 
 #############################################################################################
 
-HEADER_PROG = 'header'  # location of SIGPROC program called 'header'
+HEADER_PROG = 'header'  # location of SIGPROC program called 'header', used if the header can not be parsed directly
+
+# SIGPROC filterbank header keywords and the struct format of their values (None: flag, 's': string)
+SIGPROC_KEYWORDS = {
+	'HEADER_START':None, 'HEADER_END':None, 'FREQUENCY_START':None, 'FREQUENCY_END':None,
+	'rawdatafile':'s', 'source_name':'s',
+	'telescope_id':'i', 'machine_id':'i', 'data_type':'i', 'barycentric':'i', 'pulsarcentric':'i',
+	'nbits':'i', 'nsamples':'i', 'nbeams':'i', 'ibeam':'i', 'nchans':'i', 'nifs':'i', 'nbins':'i',
+	'az_start':'d', 'za_start':'d', 'src_raj':'d', 'src_dej':'d', 'tstart':'d', 'tsamp':'d',
+	'fch1':'d', 'foff':'d', 'fchannel':'d', 'refdm':'d', 'period':'d',
+	'npuls':'q', 'signed':'b' }
 
 #############################################################################################
 
 parser = optparse.OptionParser(usage=__doc__, version='%prog ' + '1.1  (C) 2015 Jan Wagner')
 parser.add_option('--filterbank', '-f',
 	type='str', dest='filterbankfile', default=None,
-	help='Filter bank file for which to check the start time stamp and integration period length. Requires SIGPROC utility called "header".')
+	help='Filter bank file for which to check the start time stamp and integration period length. Headers that can not be parsed directly require SIGPROC utility called "header".')
 parser.add_option('--startmjd', '-s',
 	type='float', dest='startmjd', default=None,
 	help='The starting MJD (e.g., 57300.005) of the filterbank data, if no filterbank file is specified.')
@@ -41,89 +52,115 @@ parser.add_option('--tint', '-t',
 parser.add_option('--blocks', '-b',
 	type='int', dest='blocks', default=1,
 	help='The value to be later used for the -blocks parameter of rfifind.')
+parser.add_option('--verbose', '-v',
+	action='store_true', dest='verbose', default=False,
+	help='List every flagged time range rather than just their number.')
 
 #############################################################################################
 
-def dateVEX2split(vdate):
-	"""Split VEX date string (e.g., 2015y262d11h56m15s) into its individual parts, and calculate the MJD"""
-	d = {}
-	d['vex'] = vdate
-	d['yr']  = int(vdate[0:4])
-	d['doy'] = int(vdate[5:8])
-	d['hh']  = int(vdate[9:11])
-	d['mm']  = int(vdate[12:14])
-	d['ss']  = int(vdate[15:17])
-	# Calculate month, day of month
-	dt = datetime.date.fromordinal(datetime.date(d['yr'],1,1).toordinal() + d['doy']-1)
-	d['mon']  = dt.month
-	d['mday'] = dt.day
-	# Calculate MJD
-	# http://aa.usno.navy.mil/data/docs/JulianDate.php
-	# http://www.csgnetwork.com/julianmodifdateconv.html
-	jdfract = (d['hh']-12+d['mm']/60.0+d['ss']/3600.0)/24.0
-	d['mjd'] = date_to_jd(dt.year,dt.month,dt.day)+0.5 - 2400000.5 + jdfract
-	return d
+def year2mjd(year):
+	"""Return the MJD of the start of the given year"""
+	# Seconds since Unix epoch into MJD (Unix epoch is MJD 40587.0)
+	return np.datetime64('%04d-01-01' % (int(year)), 's').astype(np.int64)/86400.0 + 40587.0
+
+def datesVEX2sec(vdates, year):
+	"""Convert a list of VEX date strings (e.g., 2015y262d11h56m15s) into an array of seconds since the start of the given year"""
+	yr  = np.array([v[0:4] for v in vdates], dtype='datetime64[Y]')
+	sec = np.array([dateVEX2sec(v) for v in vdates], dtype=np.int64)
+	t   = yr.astype('datetime64[s]') + sec.astype('timedelta64[s]')
+	return (t - np.datetime64('%04d-01-01' % (int(year)), 's')).astype(np.int64)
 
 def dateVEX2sec(vdate):
-	"""Return VEX date as seconds-of-year"""
+	"""Return VEX date as seconds since the start of its year"""
 	doy = int(vdate[5:8])
 	hh  = int(vdate[9:11])
 	mm  = int(vdate[12:14])
 	ss  = int(vdate[15:17])
-	return ss + 60.0*mm + 3600.0*hh + 86400.0*doy
+	return ss + 60*mm + 3600*hh + 86400*(doy-1)
 
 def dateSec2VEX(sec,year):
-	"""Convert seconds-of-year into VEX date"""
-	doy = int(sec/86400.0)
-	R   = sec - doy*86400.0
-	hh  = int(R/3600.0)
-	R   = R - hh*3600.0
-	mm  = int(R/60.0)
-	R   = R - mm*60.0
-	ss  = int(R)
-	return ('%04dy%03dd%02dh%02dm%02ds' % (int(year),doy,hh,mm,ss)) # 2015y262d11h56m15s
-
-def dateVEXaddsec(vdate,sec):
-	yr = vdate[0:4]
-	s = dateVEX2sec(vdate)
-	s = s + sec
-	v = dateSec2VEX(s,yr)
-	return v
-
-def doFlag(vex_tstart, vex_tstop, fb_tstart, fb_tint, zapints_list):
-	t1 = dateVEX2split(vex_tstart)
-	t2 = dateVEX2split(vex_tstop)
-	flag_startint = max(0, math.floor((t1['mjd']-fb_Tstart)/fb_Tint))
-	flag_stopint  = max(0, math.ceil((t2['mjd']-fb_Tstart)/fb_Tint))
-	if flag_startint==flag_stopint:
-		pass
-	else:
-		print ('Flag from %s to %s : ints from %d to %d' % (t1['vex'],t2['vex'],flag_startint,flag_stopint))
-		zapints_list.append('%d:%d' % (flag_startint,flag_stopint))
-
-def date_to_jd(year,month,day):
-	""" Convert a date to Julian Day.
-	Algorithm from 'Practical Astronomy with your Calculator or Spreadsheet', 
-	4th ed., Duffet-Smith and Zwart, 2011. """
-	# Copied from from https://gist.githubusercontent.com/jiffyclub/1294443/raw/02f4d41b8fa6ba7b39c577490f1e41d841cddd0b/jdutil.py
-	if month == 1 or month == 2:
-		yearp = year - 1
-		monthp = month + 12
-	else:
-		yearp = year
-		monthp = month
-	if ((year < 1582) or (year == 1582 and month < 10) or (year == 1582 and month == 10 and day < 15)):
-		B = 0 # before start of Gregorian calendar
-	else:
-		A = math.trunc(yearp / 100.)
-		B = 2 - A + math.trunc(A / 4.) #  after start of Gregorian calendar
-	if yearp < 0:
-		C = math.trunc((365.25 * yearp) - 0.75)
-	else:
-		C = math.trunc(365.25 * yearp)
-	D = math.trunc(30.6001 * (monthp + 1))
-	jd = B + C + D + day + 1720994.5
-	return jd
+	"""Convert seconds since the start of the year into VEX date"""
+	doy, R = divmod(int(sec), 86400)
+	hh, R  = divmod(R, 3600)
+	mm, ss = divmod(R, 60)
+	return ('%04dy%03dd%02dh%02dm%02ds' % (int(year),doy+1,hh,mm,ss)) # 2015y262d11h56m15s
+
+def datesSec2VEX(secs, year):
+	"""Convert an array of seconds since the start of the given year into VEX date strings, rolling over into later years"""
+	t    = np.datetime64('%04d-01-01' % (int(year)), 's') + np.asarray(secs, dtype=np.int64).astype('timedelta64[s]')
+	yrs  = t.astype('datetime64[Y]')
+	secs = (t - yrs.astype('datetime64[s]')).astype(np.int64)
+	return [dateSec2VEX(sec,yr) for (sec,yr) in zip(secs.tolist(), (yrs.astype(np.int64) + 1970).tolist())]
+
+def mjd2ints(mjd_tstarts, mjd_tstops, fb_Tstart, fb_Tint):
+	"""Convert arrays of MJD time ranges into arrays of the enclosing filterbank interval numbers"""
+	startints = np.maximum(0, np.floor((mjd_tstarts-fb_Tstart)/fb_Tint)).astype(np.int64)
+	stopints  = np.maximum(0, np.ceil((mjd_tstops-fb_Tstart)/fb_Tint)).astype(np.int64)
+	return (startints, stopints)
+
+def read_sigproc_header(path):
+	"""Parse the header of a SIGPROC filterbank file into a dictionary of keyword values"""
+	hdr = {}
+	f = open(path, 'rb')
+	try:
+		m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		try:
+			pos = 0
+			while True:
+				nchar = struct.unpack_from('i', m, pos)[0]
+				if nchar < 1 or nchar > 80:
+					raise ValueError('%s is not a SIGPROC filterbank file' % (path))
+				key = m[(pos+4):(pos+4+nchar)].decode('ascii')
+				pos = pos + 4 + nchar
+				if key not in SIGPROC_KEYWORDS:
+					raise ValueError('Unknown SIGPROC header keyword %s in %s' % (key,path))
+				fmt = SIGPROC_KEYWORDS[key]
+				if key == 'HEADER_END':
+					break
+				elif fmt == None:
+					continue
+				elif fmt == 's':
+					nchar = struct.unpack_from('i', m, pos)[0]
+					hdr[key] = m[(pos+4):(pos+4+nchar)].decode('ascii')
+					pos = pos + 4 + nchar
+				else:
+					hdr[key] = struct.unpack_from(fmt, m, pos)[0]
+					pos = pos + struct.calcsize(fmt)
+			if 'tstart' not in hdr or 'tsamp' not in hdr:
+				raise ValueError('Missing tstart or tsamp in %s' % (path))
+			# Like PRESTO (sigproc_fb.c) derive the number of samples from the data size, the
+			# 'nsamples' header value is unreliable and kept only for backwards compatibility
+			nbits  = hdr.get('nbits',0)
+			nchans = hdr.get('nchans',0)
+			if nbits < 1 or nchans < 1:
+				raise ValueError('Missing or invalid nbits/nchans in %s' % (path))
+			hdr['nsamples'] = ((len(m) - pos) * 8) // (nbits * nchans)
+		finally:
+			m.close()
+	finally:
+		f.close()
+	return hdr
+
+def call_sigproc_header(path):
+	"""Get tstart, tsamp and nsamples of a SIGPROC filterbank file from a single call of the SIGPROC utility 'header'"""
+	try:
+		p = subprocess.Popen([HEADER_PROG, path, '-tstart', '-tsamp', '-nsamples'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	except OSError as e:
+		print ('Error calling SIGPROC utility "header" (%s) : %s!' % (HEADER_PROG,str(e)))
+		sys.exit(1)
+	(out,err) = p.communicate()
+	if p.returncode != 0:
+		print ('Error calling SIGPROC utility "header" (%s) : %s!' % (HEADER_PROG,err.decode().strip()))
+		sys.exit(1)
+	vals = out.decode().split()
+	try:
+		if len(vals) != 3:
+			raise ValueError('expected 3 values but got %d' % (len(vals)))
+		# Utility 'header' reports tsamp in microseconds
+		return {'tstart':float(vals[0]), 'tsamp':float(vals[1])*1e-6, 'nsamples':int(vals[2])}
+	except ValueError as e:
+		print ('Error calling SIGPROC utility "header" (%s) : unexpected output %s, %s!' % (HEADER_PROG,str(vals),str(e)))
+		sys.exit(1)
 
 #############################################################################################
 
@@ -136,22 +173,18 @@ source    = args[1]
 telescope = args[2].upper()
 fb_Tint   = options.tint
 fb_Tstart = options.startmjd
-zapints_list = []
+fb_Nsamp  = None
 
 # Check properties of filterbank file
 if options.filterbankfile != None:
-	p1 = subprocess.Popen([HEADER_PROG, options.filterbankfile, '-tstart'],   stdout=subprocess.PIPE)
-	p2 = subprocess.Popen([HEADER_PROG, options.filterbankfile, '-tsamp'],    stdout=subprocess.PIPE)
-	p3 = subprocess.Popen([HEADER_PROG, options.filterbankfile, '-nsamples'], stdout=subprocess.PIPE)
-	s1,err = p1.communicate()
-	s2,err = p2.communicate()
-	s3,err = p3.communicate()
-	if err != None:
-		print ('Error calling SIGPROC utility "header" (%s) : %s!' % (HEADER_PROG,str(err)))
-		os.exit(1)
-	fb_Tstart = float(s1)
-	fb_Tint   = float(s2)*1e-6
-	fb_Nsamp  = int(s3)
+	try:
+		hdr = read_sigproc_header(options.filterbankfile)
+	except (ValueError, struct.error) as e:
+		print ('Warning: could not parse filterbank header (%s), trying SIGPROC utility "header" instead.' % (str(e)))
+		hdr = call_sigproc_header(options.filterbankfile)
+	fb_Tstart = hdr['tstart']
+	fb_Tint   = hdr['tsamp']
+	fb_Nsamp  = hdr['nsamples']
 	print ('Determined start time (MJD %.12f) and sampling rate (%f usec) of %s' % (fb_Tstart,fb_Tint*1e6,options.filterbankfile))
 
 # Convert integration time from seconds into MJD fraction
@@ -160,76 +193,93 @@ fb_Tint = fb_Tint / 86400.0
 # The rfifind '-zapints' works on a block level.
 # The time duration of an "interval" depends on the block length and rfifind '-blocks' setting.
 # For filterbank files the blocksize is hard-coded to 480 (sigproc_fb.c: s->spectra_per_subint = 480),
-fb_Tint = fb_Tint * 480 * options.blocks
+fb_Nspectra = 480 * options.blocks
+fb_Tint = fb_Tint * fb_Nspectra
 
 # Parse the VEX file
-scans  = vex['SCHED']
-exper  = [x for x in vex['EXPER']][0]
-Nscans = len(scans)
+scans     = vex['SCHED']
+exper     = next(iter(vex['EXPER']))
+scannames = tuple(scans)
+Nscans    = len(scannames)
 if Nscans<=1:
 	print ('Number of VEX scans is %d, nothing to do!' % (Nscans))
 	sys.exit(0)
 
-# Keep only scans of the selected station
-Nscans    = len(scans)
-scannames = [x for x in scans]
-for ii in range(Nscans):
-	stations = scans[scannames[ii]].getall('station')
-	if not any([st[0].upper() == telescope for st in stations]):
-		del scans[scannames[ii]]
-print ('Found %d VEX scans of which %d include %s.' % (Nscans,len(scans),telescope))
-if len(scans) <= 1:
+# Keep only scans of the selected station, along with that station's entries in each scan
+stations_by_scan = dict((n, scans[n].getall('station')) for n in scannames)
+stcode_upper     = dict((n, [st[0].upper() for st in sts]) for (n,sts) in stations_by_scan.items())
+records = [(n, scans[n], [st for (st,code) in zip(stations_by_scan[n],stcode_upper[n]) if code == telescope]) for n in scannames]
+records = [r for r in records if len(r[2]) > 0]
+print ('Found %d VEX scans of which %d include %s.' % (Nscans,len(records),telescope))
+if len(records) <= 1:
 	print ('Nothing to do!')
 	sys.exit(0)
-scannames = [x for x in scans]
-Nscans = len(scans)
+
+# Start times of all remaining scans in seconds since the start of the year, indexed by scan name
+year = int(records[0][1]['start'][0:4])
+year_start_mjd = year2mjd(year)
+sec_array = dict(zip([r[0] for r in records], datesVEX2sec([r[1]['start'] for r in records], year)))
 
 # Make sure we have a 'fb_Tstart'
 if fb_Tstart == None:
 	print ('Warning: filterbank file start time unspecified! Assuming it equals start of first VEX scan.')
-	fb_Tstart = scans[scannames[0]]['start']
-
-# First and last scan
-scan_1 = scans[scannames[0]]
-scan_N = scans[scannames[Nscans-1]]
+	fb_Tstart = year_start_mjd + sec_array[records[0][0]]/86400.0
 
 # Throw away all scans that are off-source
-for ii in range(Nscans):
-	if scans[scannames[ii]]['source'] != source:
-		del scans[scannames[ii]]
-Nscans    = len(scans)
-scannames = [x for x in scans]
-if Nscans<1:
+keep = [r for r in records if r[1]['source'] == source]
+if len(keep)<1:
 	print ('No scans found on source %s. Nothing to do.' % (source))
 	sys.exit(0)
 
+# On-source time ranges of the selected station
+on_tstarts = np.array([sec_array[r[0]] for r in keep], dtype=np.int64)
+on_durs    = np.array([int(r[2][0][2].split()[0]) for r in keep], dtype=np.int64)
+on_tstops  = on_tstarts + on_durs
+order      = np.argsort(on_tstarts, kind='mergesort')
+on_tstarts = on_tstarts[order]
+on_tstops  = on_tstops[order]
+# Latest end of any on-source scan so far, so that overlapping or nested scans merge
+on_tends   = np.maximum.accumulate(on_tstops)
+
+# Off-source time ranges are from the first scan to the first on-source scan, from the end of
+# on-source time to the start of the next on-source scan, and from the last on-source time to the end
+exper_stop  = vex['EXPER'][exper]['exper_nominal_stop']
+zap_tstarts = np.concatenate(([sec_array[records[0][0]]], on_tends))
+zap_tstops  = np.concatenate((on_tstarts, datesVEX2sec([exper_stop], year)))
+if sec_array[records[-1][0]] == on_tends[-1]:
+	zap_tstarts = zap_tstarts[:-1]
+	zap_tstops  = zap_tstops[:-1]
+# Drop empty or inverted ranges, e.g. where an on-source scan starts before the previous one ended
+valid       = zap_tstops > zap_tstarts
+zap_tstarts = zap_tstarts[valid]
+zap_tstops  = zap_tstops[valid]
+
 # Zap all off-source time ranges now
-zap_tstart = scan_1['start']
-for ii in range(Nscans):
-	stations = scans[scannames[ii]].getall('station')
-	for st in stations:
-		if not(st[0].upper() == telescope):
-			continue
-		zap_tstop = scans[scannames[ii]]['start']
-		doFlag(zap_tstart, zap_tstop, fb_Tstart, fb_Tint, zapints_list)	
-
-		# Start next zap from end of current on-source scan
-		dur_sec = int(st[2].split()[0])
-		zap_tstart = dateVEXaddsec(zap_tstop, dur_sec)
-if scan_N['start'] != zap_tstart:
-	zap_tstop = vex['EXPER'][exper]['exper_nominal_stop'] 
-	doFlag(zap_tstart, zap_tstop, fb_Tstart, fb_Tint, zapints_list)
+(zap_startints, zap_stopints) = mjd2ints(year_start_mjd + zap_tstarts/86400.0, year_start_mjd + zap_tstops/86400.0, fb_Tstart, fb_Tint)
+# Drop ranges past the end of the filterbank data, and truncate the last range still inside it
+if fb_Nsamp != None and fb_Nsamp > 0:
+	fb_Nints = (fb_Nsamp + fb_Nspectra - 1) // fb_Nspectra
+	Nvalid = np.searchsorted(zap_startints, fb_Nints)
+	zap_startints = zap_startints[:Nvalid]
+	zap_stopints  = np.minimum(zap_stopints[:Nvalid], fb_Nints)
+
+flagged = np.nonzero(zap_stopints > zap_startints)[0]
+zapints_list = ['%d:%d' % pair for pair in zip(zap_startints[flagged].tolist(),zap_stopints[flagged].tolist())]
+if options.verbose:
+	zap_vexstarts = datesSec2VEX(zap_tstarts[flagged], year)
+	zap_vexstops  = datesSec2VEX(zap_tstops[flagged], year)
+	for (ii,jj) in enumerate(flagged):
+		print ('Flag from %s to %s : ints from %d to %d' % (zap_vexstarts[ii],zap_vexstops[ii],zap_startints[jj],zap_stopints[jj]))
+print ('Flagged %d off-source time ranges' % (len(zapints_list)))
+if len(zapints_list) < 1:
+	print ('Nothing to flag, not writing zapints.cmd.')
+	sys.exit(0)
 
 # Write out a 'rfifind -zapints a:b' command file
-f = open('zapints.cmd', 'w')
-f.write('rfifind -blocks %d -o %s -zapints ' % (options.blocks,exper))
-for ii in range(len(zapints_list)):
-	f.write(zapints_list[ii])
-	if ii<(len(zapints_list)-1):
-		f.write(',')
-
+cmd = 'rfifind -blocks %d -o %s -zapints %s' % (options.blocks,exper,','.join(zapints_list))
 if options.filterbankfile != None:
-	f.write(' -filterbank %s' % (options.filterbankfile))
-
+	cmd = cmd + ' -filterbank %s' % (options.filterbankfile)
+f = open('zapints.cmd', 'w')
+f.write(cmd)
 f.close()
 print('Wrote new zapints.cmd file')